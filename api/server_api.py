@@ -5,68 +5,153 @@ API REST do driver Modbus.
 Usa FastAPI para comunicação com Node-RED.
 """
 
-from fastapi import FastAPI, Query, Body, HTTPException
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import List, Literal
+
+import orjson
+import queue
+from fastapi import APIRouter, FastAPI, Query, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
 import uvicorn
 from datetime import datetime
 from manager.modbus_driver_manager import ModbusDriverManager
 from core.logger import logger
+from core.memory import ns_to_datetime, quality_name_from_code
+
+
+class PointWrite(BaseModel):
+    """
+    Corpo de escrita de um ponto. A validação/coerção roda no pydantic-core
+    (Rust) em uma passada, no lugar do parse manual de dict por request.
+    """
+    area: Literal["HR", "CO"] = "HR"
+    address: int = Field(ge=0)
+    value: int = Field(ge=-32768, le=65535)
+
+    @field_validator("area", mode="before")
+    @classmethod
+    def _normalize_area(cls, v):
+        return v.upper() if isinstance(v, str) else v
+
+    @field_validator("value")
+    @classmethod
+    def _wrap_negative(cls, v):
+        # Complemento de dois: valores negativos viram o registrador de 16 bits
+        return v + 65536 if v < 0 else v
 
-app = FastAPI(title="Modbus Driver API", version="1.0.0")
+# Instância única do gerenciador, registrada no startup (main.py ou lifespan).
+# Guardada no módulo: get_manager vira uma leitura de global, sem o
+# getattr em app.state a cada request.
+_manager: ModbusDriverManager = None
 
 
-def get_manager():
-    m = getattr(app.state, "manager", None)
-    if not m:
+def set_manager(manager: ModbusDriverManager):
+    """Registra o manager usado pelos endpoints (chamado uma vez no startup)."""
+    global _manager
+    _manager = manager
+
+
+def get_manager() -> ModbusDriverManager:
+    if _manager is None:
         raise HTTPException(status_code=500, detail="Manager não inicializado")
-    return m
-# # Instância global do gerenciador
-# manager = ModbusDriverManager()
+    return _manager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Garante exatamente uma instância do ModbusDriverManager por processo:
+    cria uma se o main.py ainda não registrou, e para o driver no shutdown.
+    """
+    if _manager is None:
+        set_manager(ModbusDriverManager())
+    yield
+    m = _manager
+    if m and m.server and m.server.is_running():
+        m.stop_driver()
+
 
-@app.get("/status")
-def get_status():
+# ORJSONResponse serializa com orjson (caminho em Rust/C), bem mais rápido que
+# o json da stdlib para payloads grandes de /points; trata datetime e Enum nativamente.
+app = FastAPI(title="Modbus Driver API", version="1.0.0",
+              default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Um APIRouter por preocupação: ciclo de vida/status, debug e pontos
+status_router = APIRouter(tags=["driver"])
+debug_router = APIRouter(tags=["debug"])
+points_router = APIRouter(tags=["points"])
+
+# Respostas dos endpoints quentes são serializadas direto com orjson e
+# devolvidas como Response pronta: devolver dict deixaria o FastAPI passar o
+# payload pelo jsonable_encoder (caminhada em Python puro sobre cada ponto)
+# antes de encodar. orjson trata dataclass/Enum/datetime nativamente;
+# OPT_NON_STR_KEYS cobre os dicts {endereço: ponto} com chave inteira.
+def _orjson_response(payload) -> Response:
+    return Response(content=orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+                    media_type="application/json")
+
+
+# Cache do /status serializado: chave = (versão de estado do manager, versão
+# dos contadores de conexão do servidor, segundo atual). Enquanto nada mudou,
+# devolve os mesmos bytes sem remontar/encodar o dict; qualquer operação
+# Modbus invalida a chave, então reads/writes nunca saem defasados.
+_status_cache = {"key": None, "body": b""}
+
+
+@status_router.get("/status")
+async def get_status():
     """Retorna o status atual do driver."""
+    # Endpoint somente leitura: roda direto no event loop, sem threadpool.
     m = get_manager()
-    status = m.get_status()
-    return JSONResponse(content=jsonable_encoder(status))
+    srv = m.server
+    key = (m.status_version,
+           srv.stats_version if srv is not None else -1,
+           int(time.time()))
+    if _status_cache["key"] != key:
+        _status_cache["body"] = orjson.dumps(m.get_status())
+        _status_cache["key"] = key
+    return Response(content=_status_cache["body"], media_type="application/json")
 
-@app.post("/start")
-def start_driver():
+@status_router.post("/start")
+async def start_driver():
     """Inicia o driver Modbus."""
     m = get_manager()
-    ok = m.start_driver()
+    # start_driver bloqueia (socket + espera de inicialização); roda fora do loop
+    ok = await asyncio.to_thread(m.start_driver)
     if ok:
         return {"message": "Driver iniciado com sucesso."}
-    return JSONResponse(status_code=400, content={"error": "Falha ao iniciar driver."})
+    return ORJSONResponse(status_code=400, content={"error": "Falha ao iniciar driver."})
 
-@app.post("/stop")
-def stop_driver():
+@status_router.post("/stop")
+async def stop_driver():
     """Para o driver Modbus."""
     m = get_manager()
-    ok = m.stop_driver()
+    ok = await asyncio.to_thread(m.stop_driver)
     if ok:
         return {"message": "Driver parado com sucesso."}
-    return JSONResponse(status_code=400, content={"error": "Falha ao parar driver."})
+    return ORJSONResponse(status_code=400, content={"error": "Falha ao parar driver."})
 
-@app.post("/restart")
-def restart_driver():
+@status_router.post("/restart")
+async def restart_driver():
     """Reinicia o driver Modbus."""
     m = get_manager()
-    ok = m.restart_driver()
+    ok = await asyncio.to_thread(m.restart_driver)
     if ok:
         return {"message": "Driver reiniciado com sucesso."}
-    return JSONResponse(status_code=400, content={"error": "Falha ao reiniciar driver."})
+    return ORJSONResponse(status_code=400, content={"error": "Falha ao reiniciar driver."})
 
-@app.post("/debug/on")
-def enable_debug():
+@debug_router.post("/debug/on")
+async def enable_debug():
     """Ativa modo debug."""
     m = get_manager()
     m.set_debug_mode(True)
     return {"message": "Modo debug ativado."}
 
-@app.post("/debug/off")
-def disable_debug():
+@debug_router.post("/debug/off")
+async def disable_debug():
     """Desativa modo debug."""
     m = get_manager()
     m.set_debug_mode(False)
@@ -75,27 +160,44 @@ def disable_debug():
 # --------------------------------------------------------------
 # 🔸 Leitura de memória (todas as áreas ou ponto específico)
 # --------------------------------------------------------------
-@app.get("/points")
-def get_points(area: str = Query(default="HR"), address: int = Query(default=None)):
+@points_router.get("/points")
+async def get_points(area: str = Query(default="HR"), address: int = Query(default=None)):
     """
     Lê pontos Modbus da memória interna.
-    - area: HR, CO, DI, IR
+    - area: HR, CO, DI, IR — ou ALL para as quatro áreas em uma chamada só
     - address: opcional; se informado, retorna apenas o ponto.
     """
     m = get_manager()
     if not m.server or not m.server.is_running():
-        return JSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
+        return ORJSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
     try:
+        # Normaliza a área uma única vez na borda da API
+        area = area.upper()
+        if area == "ALL":
+            if address is not None:
+                return ORJSONResponse(status_code=400,
+                                      content={"error": "address não se aplica a area=ALL"})
+            # Coalesce as quatro consultas em uma única viagem HTTP
+            return _orjson_response({
+                a: {"area": a, "points": m.memory.all_points(a)}
+                for a in ("HR", "CO", "DI", "IR")
+            })
         if address is not None:
             point = m.memory.read_point(address, area)
-            if not point:
-                return JSONResponse(status_code=404, content={"error": f"Endereço {address} não encontrado em {area}"})
-            return {"area": area, "address": address, **point}
+            if point is None:
+                return ORJSONResponse(status_code=404, content={"error": f"Endereço {address} não encontrado em {area}"})
+            return _orjson_response({
+                "area": area,
+                "address": address,
+                "value": point.value,
+                "quality": point.quality,
+                "timestamp": point.timestamp,
+            })
         else:
             points = m.memory.all_points(area)
-            return {"area": area, "points": points}
+            return _orjson_response({"area": area, "points": points})
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 # ----------------------------------------------------------------------
 # 🔸 Leitura de memória a partir de um timestamp específico (por área)
@@ -112,29 +214,42 @@ def parse_iso8601_local(s: str) -> datetime:
         dt = dt.astimezone()  # converte para datetime local-aware
     return dt
 
-@app.get("/points/changed")
-def get_changed_points(
+@points_router.get("/points/changed")
+async def get_changed_points(
     area: str = Query(default="HR"),
-    since: str = Query(..., description="ISO datetime, ex: 2025-11-01T03:00:00Z")
+    since: str = Query(default=None, description="ISO datetime, ex: 2025-11-01T03:00:00Z"),
+    since_version: int = Query(default=None, description="Versão retornada na consulta anterior"),
 ):
+    """
+    Retorna pontos alterados. Aceita 'since' (timestamp ISO) ou
+    'since_version' (contador de versão da Memory, O(alterados) por consulta).
+    A resposta sempre inclui 'version' para o cliente usar na próxima chamada.
+    """
     m = get_manager()
     if not m.server or not m.server.is_running():
-        return JSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
+        return ORJSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
 
     try:
-        ts = parse_iso8601_local(since)
-        changed = m.memory.changed_points(ts, area.upper())
+        if since_version is not None:
+            version, changed = m.memory.changed_since_version(since_version, area.upper())
+        elif since is not None:
+            # Converte para ns de epoch uma única vez; a Memory compara inteiros
+            ts_ns = int(parse_iso8601_local(since).timestamp() * 1e9)
+            changed = m.memory.changed_points(ts_ns, area.upper())
+            version = m.memory.version
+        else:
+            return ORJSONResponse(status_code=400, content={"error": "Informe 'since' ou 'since_version'."})
 
-        return { "area": area, "changed": changed }
+        return _orjson_response({"area": area, "version": version, "changed": changed})
 
     except Exception as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
+        return ORJSONResponse(status_code=400, content={"error": str(e)})
 
 # --------------------------------------------------------------
 # 🔸 Escrita de memória (HR ou CO)
 # --------------------------------------------------------------
-@app.post("/points")
-def set_point(data: dict = Body(...)):
+@points_router.post("/points")
+async def set_point(pw: PointWrite):
     """
     Escreve um valor na memória (simula escrita Modbus).
     Exemplo corpo JSON:
@@ -143,42 +258,158 @@ def set_point(data: dict = Body(...)):
         "address": 5,
         "value": 123
     }
+
+    Range, sinal e área válida são garantidos pelo modelo PointWrite;
+    escritas em IR/DI são rejeitadas na validação (422).
     """
     m = get_manager()
     if not m.server or not m.server.is_running():
-        return JSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
+        return ORJSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
     try:
-        area = data.get("area", "HR").upper()
-        address = int(data["address"])
-        value = int(data["value"])
-
-        # Verifica se o valor de value é positivo/negativo dentro da faixa limite e adequa se necessário
-        if value < -32768 or value > 65535:
-            return JSONResponse(status_code=400, content={"error": f"O valor está fora do range aceitável."})
-        if value < 0:
-            value = 65536 + value
-
-        # Atualiza o DataBlock Modbus que consequentemente sincroniza a Memory
+        # Atualiza o DataBlock Modbus que consequentemente sincroniza a Memory.
+        # setValues passa pelo lock do datastore pymodbus; roda em thread para
+        # não bloquear o event loop.
         ctx = m.server.context
         if ctx:
             unit_id = m.server.unit_id
             slave = ctx[unit_id] if not ctx.single else ctx
-            if area == "HR":
-                slave.setValues(3, address, [value])
-            elif area == "CO":
-                slave.setValues(1, address, [value])
-            # IR e DI são somente leitura, não atualizam. Se tentar escrever em IR/DI é levantado um PermissionError na Memory
-        
-        logger.info(f"API: escrita em {area}[{address}] = {value}")
-        return {"status": "OK", "message": f"{area}[{address}] atualizado para {value}"}
+            func_code = 3 if pw.area == "HR" else 1
+            await asyncio.to_thread(slave.setValues, func_code, pw.address, [pw.value])
+
+        # Formatação %-style adiada: só é expandida se o registro for emitido
+        logger.info("API: escrita em %s[%d] = %d", pw.area, pw.address, pw.value)
+        return {"status": "OK", "message": f"{pw.area}[{pw.address}] atualizado para {pw.value}"}
 
     except PermissionError as e:
-        return JSONResponse(status_code=403, content={"error": str(e)})
-    except KeyError as e:
-        return JSONResponse(status_code=400, content={"error": f"Campo ausente: {e}"})
+        return ORJSONResponse(status_code=403, content={"error": str(e)})
+    except Exception as e:
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
+
+# ----------------------------------------------------------------------
+# 🔸 Assinatura de alterações via WebSocket (empurra deltas, sem polling)
+# ----------------------------------------------------------------------
+@points_router.websocket("/ws/points")
+async def ws_points(ws: WebSocket):
+    """
+    Empurra alterações de pontos conforme elas acontecem, dispensando o
+    polling de /points/changed.
+
+    Protocolo: o cliente envia um JSON inicial {"area": "HR",
+    "since_version": N}; o servidor responde com os pontos perdidos desde
+    essa versão (se informada) e depois envia um evento por escrita:
+    {"area", "version", "address", "value", "quality", "timestamp"}.
+    """
+    await ws.accept()
+    m = _manager
+    if m is None or not m.server or not m.server.is_running():
+        await ws.close(code=1013, reason="Driver Modbus não está em execução")
+        return
+
+    try:
+        params = await ws.receive_json()
+        area = str(params.get("area", "HR")).upper()
+        since_version = params.get("since_version")
+        memory = m.memory
+        sub_queue = memory.subscribe(area)
+    except WebSocketDisconnect:
+        return
+    except Exception as e:
+        await ws.close(code=1008, reason=str(e))
+        return
+
+    try:
+        # Recupera o que o cliente perdeu desde a última versão conhecida
+        if since_version is not None:
+            version, changed = memory.changed_since_version(since_version, area)
+            await ws.send_bytes(orjson.dumps(
+                {"area": area, "version": version, "changed": changed},
+                option=orjson.OPT_NON_STR_KEYS,
+            ))
+
+        while True:
+            try:
+                # Timeout curto para a thread não ficar presa se o cliente sumir
+                delta = await asyncio.to_thread(sub_queue.get, True, 1.0)
+            except queue.Empty:
+                # Cada start/restart (inclusive os do watchdog) troca
+                # manager.memory por uma instância nova; esta assinatura ficou
+                # órfã e nunca mais receberia deltas. Fecha com 1012 (service
+                # restart) para o cliente reconectar e ressincronizar.
+                if m.memory is not memory:
+                    await ws.close(code=1012, reason="Driver reiniciado; reconecte")
+                    return
+                continue
+            version, address, value, quality_code, ts_ns = delta
+            # Mesmo formato externo do replay (Point): quality por nome e
+            # timestamp como datetime ISO, não ns crus
+            await ws.send_bytes(orjson.dumps({
+                "area": area,
+                "version": version,
+                "address": address,
+                "value": value,
+                "quality": quality_name_from_code(quality_code),
+                "timestamp": ns_to_datetime(ts_ns),
+            }))
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.debug("WebSocket /ws/points encerrado: %s", e)
+    finally:
+        memory.unsubscribe(sub_queue)
+
+# --------------------------------------------------------------
+# 🔸 Escrita em lote (HR ou CO)
+# --------------------------------------------------------------
+@points_router.post("/points/batch")
+async def set_points_batch(items: List[PointWrite]):
+    """
+    Escreve vários pontos em uma única chamada HTTP.
+    Corpo JSON: lista de objetos {"area": "HR", "address": 5, "value": 123}.
+
+    A lista inteira é validada em uma única passada do pydantic-core;
+    endereços contíguos da mesma área são agrupados e aplicados com um
+    único setValues por bloco, em vez de uma escrita por ponto.
+    """
+    m = get_manager()
+    if not m.server or not m.server.is_running():
+        return ORJSONResponse(status_code=503, content={"error": "Driver Modbus não está em execução"})
+    try:
+        ctx = m.server.context
+        unit_id = m.server.unit_id
+        slave = ctx[unit_id] if not ctx.single else ctx
+
+        parsed = [(pw.area, pw.address, pw.value) for pw in items]
+        results = [{"area": a, "address": addr, "status": "OK"} for a, addr, _ in parsed]
+
+        # Agrupa escritas contíguas por (área, endereço): um setValues por bloco
+        parsed.sort()
+        func_code = {"HR": 3, "CO": 1}
+        runs = []
+        for area, address, value in parsed:
+            if runs and runs[-1][0] == area and address == runs[-1][1] + len(runs[-1][2]):
+                runs[-1][2].append(value)
+            else:
+                runs.append((area, address, [value]))
+        for area, start, values in runs:
+            await asyncio.to_thread(slave.setValues, func_code[area], start, values)
+
+        logger.info("API: escrita em lote de %d ponto(s) em %d bloco(s)", len(parsed), len(runs))
+        return {"status": "OK", "written": len(parsed), "results": results}
+
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
+
+# Monta a aplicação a partir dos routers
+app.include_router(status_router)
+app.include_router(debug_router)
+app.include_router(points_router)
 
 if __name__ == "__main__":
     logger.info("Iniciando API REST Modbus Driver (porta 8000)...")
-    uvicorn.run("api.server_api:app", host="0.0.0.0", port=8000, reload=False)
+    # loop/http "auto": usa uvloop e httptools (requirements.txt) quando
+    # disponíveis, caindo no asyncio/h11 padrão caso contrário.
+    # workers fica em 1 de propósito: o manager e a Memory vivem neste
+    # processo — com N workers cada um subiria um driver Modbus próprio
+    # disputando a mesma porta e com memórias divergentes.
+    uvicorn.run("api.server_api:app", host="0.0.0.0", port=8000, reload=False,
+                loop="auto", http="auto")
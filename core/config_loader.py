@@ -11,6 +11,7 @@ de forma centralizada e consistente em todo o projeto.
 """
 
 import configparser
+import functools
 import os
 
 
@@ -18,12 +19,15 @@ import os
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config', 'settings.ini')
 
 
+@functools.lru_cache(maxsize=1)
 def load_config():
     """
     Lê o arquivo settings.ini e retorna um objeto ConfigParser com as configurações carregadas.
 
-    Essa função é chamada sempre que o driver for inicializado ou reinicializado via API.
-    Se o arquivo não existir ou estiver mal formatado, lança exceções específicas.
+    O resultado fica em cache: chamadas repetidas (logger, memória, manager)
+    reutilizam o mesmo objeto sem reabrir nem re-parsear o arquivo. Quem
+    precisar reler o arquivo do disco (ex: restart via API) deve chamar
+    reload_config() antes.
 
     Returns:
         configparser.ConfigParser: objeto contendo as configurações carregadas.
@@ -41,6 +45,14 @@ def load_config():
     return config
 
 
+def reload_config():
+    """
+    Invalida o cache do load_config, forçando a releitura do settings.ini
+    na próxima chamada. Usado nos caminhos de start/restart do driver.
+    """
+    load_config.cache_clear()
+
+
 def get_config_value(section: str, key: str, default=None):
     """
     Retorna o valor de uma chave específica dentro de uma seção do arquivo settings.ini.
@@ -12,19 +12,24 @@ Usa o módulo logging do Python com RotatingFileHandler.
 """
 
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from .config_loader import load_config
 
 # Variável global de controle do nível de debug
 DEBUG_ENABLED = False
 
+# Listener em background que faz a escrita em disco (rotação inclusa).
+# O caminho de request só enfileira o registro — nunca bloqueia em I/O.
+_listener = None
+
 
 def setup_logger():
     """
     Configura o logger principal do sistema com base no settings.ini.
     A função pode ser chamada várias vezes (por exemplo, após reload de configuração).
     """
-    global DEBUG_ENABLED
+    global DEBUG_ENABLED, _listener
 
     # Carrega configurações
     config = load_config()
@@ -45,7 +50,12 @@ def setup_logger():
     logger.setLevel(log_level)
     logger.handlers.clear()  # Evita duplicação se setup_logger for chamado novamente
 
-    handler = RotatingFileHandler(
+    # Encerra o listener anterior, se setup_logger for chamado novamente
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    file_handler = RotatingFileHandler(
         log_file, maxBytes=log_max*1024*1024, backupCount=5, encoding='utf-8'
     )
 
@@ -53,8 +63,14 @@ def setup_logger():
         fmt='%(asctime)s [%(levelname)s] %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    file_handler.setFormatter(formatter)
+
+    # O logger só enfileira; o QueueListener (thread própria) grava em disco.
+    # Assim nenhuma thread de request/Modbus bloqueia no handler de arquivo.
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    _listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
 
     return logger
 
@@ -6,124 +6,372 @@ Responsável por armazenar em memória os pontos Modbus
 
 Os valores são voláteis (RAM). Essa estrutura será acessada
 tanto pelo servidor Modbus quanto pela API e pelo Manager.
+
+Layout interno: em vez de um dicionário por endereço (um dict + datetime +
+enum por ponto), cada área guarda três arrays paralelos (SoA):
+    - values: array('H') de 16 bits para HR/IR (casa com o registrador
+      Modbus); bytearray de 0/1 para CO/DI (1 byte por ponto de bit)
+    - quality: bytearray com o código da qualidade (1 byte por ponto)
+    - timestamps: array('q') com o instante da última alteração em
+      nanossegundos de epoch (time.time_ns())
+
+Isso reduz o consumo por ponto de centenas de bytes para poucos bytes e
+deixa as varreduras (all_points / changed_points) percorrendo memória
+contígua. O formato externo é o dataclass Point (value, quality,
+timestamp), materializado apenas na hora da leitura.
 """
 
+import queue
+import time
+from array import array
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from enum import Enum
+from enum import IntEnum
 from threading import Lock
 
 
-class PointQuality(str, Enum):
-    """Estado de qualidade do ponto."""
-    OK = "OK"          # valor válido
-    BAD = "BAD"        # erro ou valor inválido
-    STALE = "STALE"    # desatualizado
-    UNKNOWN = "UNKNOWN"  # ponto ainda não inicializado
+class PointQuality(IntEnum):
+    """
+    Estado de qualidade do ponto. IntEnum: o valor do membro É o código de
+    1 byte gravado no bytearray SoA — sem tabela de tradução nem alocação
+    de string por escrita. O nome ("OK", "BAD", ...) só aparece na
+    serialização, via quality_name_from_code.
+    """
+    OK = 0        # valor válido
+    BAD = 1       # erro ou valor inválido
+    STALE = 2     # desatualizado
+    UNKNOWN = 3   # ponto ainda não inicializado
+
+
+# Nomes pré-computados por código: o que vai para o JSON da API
+_CODE_TO_NAME = tuple(quality.name for quality in PointQuality)
+
+_NS_PER_SECOND = 1_000_000_000
+
+# Janela de escritas recentes lembradas por área para o caminho O(k) de
+# changed_since_version; pedidos mais antigos que a janela caem no scan completo.
+_DIRTY_WINDOW = 1024
+
+
+def ns_to_datetime(ns: int) -> datetime:
+    """Converte nanossegundos de epoch em datetime local-aware (só na borda)."""
+    return datetime.fromtimestamp(ns / _NS_PER_SECOND).astimezone()
+
+
+def quality_name_from_code(code: int) -> str:
+    """Converte o código compacto (0..3) no nome usado no JSON ("OK", ...)."""
+    return _CODE_TO_NAME[code]
+
+
+@dataclass(slots=True)
+class Point:
+    """
+    Registro materializado de um ponto (formato externo da Memory).
+    slots=True: sem __dict__ por instância — acesso a atributo mais rápido e
+    ~4x menos memória que o dict de 3 chaves usado antes. orjson e o
+    jsonable_encoder do FastAPI serializam dataclasses nativamente, então o
+    JSON continua com as chaves value/quality/timestamp (quality é o
+    nome do PointQuality, ex.: "OK").
+    """
+    value: int
+    quality: str
+    timestamp: datetime
+
+
+def _to_ns(since) -> int:
+    """Aceita datetime ou int em nanossegundos e normaliza para int."""
+    if isinstance(since, datetime):
+        return int(since.timestamp() * _NS_PER_SECOND)
+    return int(since)
+
+
+class _AreaBlock:
+    """
+    Bloco SoA de uma área Modbus: três arrays paralelos indexados
+    diretamente pelo endereço do ponto.
+    """
+
+    __slots__ = ("name", "values", "quality", "timestamps", "versions", "dirty", "writable", "bit")
+
+    def __init__(self, name: str, count: int, default_value: int, writable: bool, bit: bool = False):
+        now_ns = time.time_ns()
+        self.name = name
+        self.bit = bit
+        if bit:
+            # CO/DI: 1 byte por ponto, valores normalizados para 0/1
+            self.values = bytearray([1 if default_value else 0] * count)
+        else:
+            self.values = array("H", [default_value & 0xFFFF] * count)
+        self.quality = bytearray([PointQuality.UNKNOWN] * count)
+        self.timestamps = array("q", [now_ns] * count)
+        self.versions = array("q", [0] * count)           # versão da última escrita por ponto
+        self.dirty = deque(maxlen=_DIRTY_WINDOW)          # cauda de (versão, endereço) recentes
+        self.writable = writable
+
+    def __len__(self):
+        return len(self.values)
+
+    def make_point(self, address: int) -> "Point":
+        """Materializa o registro externo de um ponto."""
+        return Point(
+            self.values[address],
+            _CODE_TO_NAME[self.quality[address]],
+            ns_to_datetime(self.timestamps[address]),
+        )
 
 
 class Memory:
     """
-    Armazena todos os pontos Modbus em dicionários.
+    Armazena todos os pontos Modbus em arrays paralelos por área (SoA).
 
-    Cada ponto:
-        {
-            "value": int,
-            "quality": PointQuality,
-            "timestamp": datetime
-        }
+    Cada ponto, quando lido, é materializado como um Point
+    (value, quality, timestamp).
 
-    O Lock garante segurança em acesso concorrente (threads/API).
+    Concorrência: leitores não tomam lock (elementos/slices de array são
+    atômicos sob o GIL); apenas os escritores serializam entre si via
+    _writer_lock, no padrão single-writer/multi-reader.
     """
 
     def __init__(self, hr_count: int = 100, co_count: int = 0, di_count: int = 0, ir_count: int = 0, default_value: int = 0,):
         """Inicializa as áreas de memória Modbus."""
-        self._lock = Lock()
-
-        def make_block(count):
-            return {
-                addr: {
-                    "value": default_value,
-                    "quality": PointQuality.UNKNOWN,
-                    "timestamp": datetime.now().astimezone(),
-                }
-                for addr in range(count)
-            }
-
-        self.holding = make_block(hr_count)          # Holding Registers (R/W)
-        self.coils = make_block(co_count)            # Coils (R/W)
-        self.discrete_inputs = make_block(di_count)  # Discrete Inputs (R)
-        self.input_registers = make_block(ir_count)  # Input Registers (R)
-
-    def _get_table(self, area: str):
-        """Seleciona o bloco de memória conforme a área."""
+        self._writer_lock = Lock()
+        self._version = 0  # contador global monotônico, incrementado a cada escrita
+        self._subscribers = []  # [(área, SimpleQueue)] de assinantes de deltas
+
+        self.holding = _AreaBlock("HR", hr_count, default_value, writable=True)           # Holding Registers (R/W)
+        self.coils = _AreaBlock("CO", co_count, default_value, writable=True, bit=True)             # Coils (R/W)
+        self.discrete_inputs = _AreaBlock("DI", di_count, default_value, writable=False, bit=True)  # Discrete Inputs (R)
+        self.input_registers = _AreaBlock("IR", ir_count, default_value, writable=False)  # Input Registers (R)
+
+        # Dispatch por dicionário: um lookup em vez da cadeia if/elif + upper
+        self._tables = {
+            "HR": self.holding,
+            "CO": self.coils,
+            "DI": self.discrete_inputs,
+            "IR": self.input_registers,
+        }
+
+    def _get_table(self, area: str) -> _AreaBlock:
+        """Seleciona o bloco de memória conforme a área (lookup direto)."""
+        try:
+            return self._tables[area]
+        except KeyError:
+            pass
+        # Tolera área em minúsculas vinda de chamadores externos (caminho frio)
+        try:
+            return self._tables[area.upper()]
+        except KeyError:
+            raise ValueError(f"Área inválida: {area}") from None
+
+    @property
+    def version(self) -> int:
+        """Versão global atual (última escrita aplicada)."""
+        return self._version
+
+    def _stamp(self, table: _AreaBlock, address: int):
+        """
+        Registra uma escrita no contador de versão e notifica assinantes
+        da área (chamar com o lock).
+        """
+        self._version += 1
+        table.versions[address] = self._version
+        table.dirty.append((self._version, address))
+        if self._subscribers:
+            delta = (self._version, address, table.values[address],
+                     table.quality[address], table.timestamps[address])
+            for area_name, sub_queue in self._subscribers:
+                if area_name == table.name:
+                    sub_queue.put_nowait(delta)
+
+    def subscribe(self, area: str = "HR"):
+        """
+        Registra um assinante de deltas de uma área. Cada escrita coloca
+        (versão, endereço, valor, código de qualidade, timestamp_ns) na fila
+        retornada. O chamador deve chamar unsubscribe ao terminar.
+        """
         area = area.upper()
-        if area == "HR":
-            return self.holding
-        elif area == "CO":
-            return self.coils
-        elif area == "DI":
-            return self.discrete_inputs
-        elif area == "IR":
-            return self.input_registers
-        else:
+        if area not in self._tables:
             raise ValueError(f"Área inválida: {area}")
-    
+        sub_queue = queue.SimpleQueue()
+        with self._writer_lock:
+            self._subscribers.append((area, sub_queue))
+        return sub_queue
+
+    def unsubscribe(self, sub_queue):
+        """Remove um assinante registrado via subscribe."""
+        with self._writer_lock:
+            self._subscribers = [
+                (area, q) for area, q in self._subscribers if q is not sub_queue
+            ]
+
+    def _snapshot(self, area: str):
+        """
+        Copia os arrays de uma área (memcpy em C) e devolve
+        (values, quality, timestamps), sem tomar o lock: sob o GIL cada slice
+        é consistente, e uma escrita concorrente entre os três slices só
+        defasa value/quality/timestamp de um ponto em uma escrita — desvio
+        aceitável para leitores de polling, que veem a escrita na próxima
+        consulta. O lock fica reservado aos escritores.
+        """
+        table = self._get_table(area)
+        return table.values[:], bytes(table.quality), table.timestamps[:]
+
+    def snapshot_values(self, area: str = "HR"):
+        """
+        Retorna só os valores de uma área como list[int], sem materializar
+        Points: conversão direta do buffer SoA em C. Usado pelo servidor
+        Modbus para carregar os DataBlocks na inicialização.
+        """
+        return list(self._get_table(area).values)
+
     def read_point(self, address: int, area: str = "HR"):
-        """Lê um ponto específico de uma área."""
-        with self._lock:
-            table = self._get_table(area)
-            return table.get(address)
+        """
+        Lê um ponto específico de uma área, sem lock: leituras de elemento
+        único de array/bytearray são atômicas sob o GIL. O tráfego é
+        fortemente read-heavy (polling Modbus/API); tirar o acquire/release
+        por leitura elimina o pingue-pongue do lock entre as threads.
+        """
+        table = self._get_table(area)
+        if not 0 <= address < len(table):
+            return None
+        value = table.values[address]
+        quality_code = table.quality[address]
+        ts_ns = table.timestamps[address]
+        return Point(value, _CODE_TO_NAME[quality_code], ns_to_datetime(ts_ns))
 
     def write_point(self, address: int, value: int, area: str = "HR"):
         """Escreve um valor em uma área (HR/CO)."""
-        if area.upper() in ("DI", "IR"):
-            raise PermissionError(f"A área {area} é somente leitura.")
-        with self._lock:
+        with self._writer_lock:
             table = self._get_table(area)
-            if address not in table:
+            if not table.writable:
+                raise PermissionError(f"A área {area} é somente leitura.")
+            if not 0 <= address < len(table):
                 raise KeyError(f"Endereço inválido: {address}")
-            table[address]["value"] = value
-            table[address]["quality"] = PointQuality.OK
-            table[address]["timestamp"] = datetime.now().astimezone()
+            table.values[address] = (1 if value else 0) if table.bit else value & 0xFFFF
+            table.quality[address] = PointQuality.OK
+            table.timestamps[address] = time.time_ns()
+            self._stamp(table, address)
+
+    def write_range(self, start: int, values, area: str = "HR"):
+        """
+        Escreve um bloco contíguo de valores (HR/CO) com uma única aquisição
+        do lock. É o caminho usado pelos DataBlocks do servidor Modbus: um
+        write de 125 registradores vira três atribuições de slice em vez de
+        125 chamadas a write_point (125 locks + 125 time_ns()).
+        """
+        count = len(values)
+        if count == 0:
+            return
+        with self._writer_lock:
+            table = self._get_table(area)
+            if not table.writable:
+                raise PermissionError(f"A área {area} é somente leitura.")
+            end = start + count
+            if start < 0 or end > len(table):
+                raise KeyError(f"Faixa inválida: {start}..{end - 1}")
+            now_ns = time.time_ns()
+            if table.bit:
+                table.values[start:end] = bytes(1 if v else 0 for v in values)
+            else:
+                table.values[start:end] = array("H", [v & 0xFFFF for v in values])
+            table.quality[start:end] = bytes([PointQuality.OK]) * count
+            table.timestamps[start:end] = array("q", [now_ns] * count)
+            for addr in range(start, end):
+                self._stamp(table, addr)
 
     def set_quality(self, address: int, quality: PointQuality, area: str = "HR"):
         """Altera a qualidade de um ponto."""
-        with self._lock:
+        with self._writer_lock:
             table = self._get_table(area)
-            if address in table:
-                table[address]["quality"] = quality
-                table[address]["timestamp"] = datetime.now().astimezone()
+            if 0 <= address < len(table):
+                table.quality[address] = PointQuality(quality)
+                table.timestamps[address] = time.time_ns()
+                self._stamp(table, address)
 
     def all_points(self, area: str = "HR"):
-        """Retorna uma cópia dos pontos atuais de uma área."""
-        with self._lock:
-            table = self._get_table(area)
-            return table.copy()
+        """Retorna os pontos atuais de uma área, materializados em Points."""
+        values, quality, timestamps = self._snapshot(area)
+        # Globais viram locais do comprehension: no laço mais quente da API
+        # (10k pontos por GET), cada lookup economizado conta.
+        point, codes, to_dt = Point, _CODE_TO_NAME, ns_to_datetime
+        return {
+            addr: point(values[addr], codes[quality[addr]], to_dt(timestamps[addr]))
+            for addr in range(len(values))
+        }
 
-    def changed_points(self, since: datetime, area: str = "HR"):
-        """Retorna pontos alterados desde um timestamp."""
-        with self._lock:
+    def changed_points(self, since, area: str = "HR"):
+        """
+        Retorna pontos alterados desde um timestamp.
+        Aceita datetime ou int em nanossegundos de epoch; a comparação
+        interna é feita sobre inteiros (sem objetos datetime).
+        """
+        since_ns = _to_ns(since)
+        values, quality, timestamps = self._snapshot(area)
+        point, codes, to_dt = Point, _CODE_TO_NAME, ns_to_datetime
+        # varredura direta do array de inteiros: comparação em C, sem
+        # indexação repetida de timestamps
+        return {
+            addr: point(values[addr], codes[quality[addr]], to_dt(ts))
+            for addr, ts in enumerate(timestamps)
+            if ts > since_ns
+        }
+
+    def changed_since_version(self, since_version: int, area: str = "HR"):
+        """
+        Retorna (versão_atual, {addr: ponto}) com os pontos alterados depois
+        de since_version. Usa a cauda de escritas recentes (O(k) no número de
+        alterações); se o pedido for mais antigo que a janela, cai no scan
+        completo do array de versões. Um since_version acima do contador
+        atual prova que esta Memory é nova (restart zera o contador): nesse
+        caso devolve a tabela inteira para o cliente ressincronizar.
+        """
+        since_version = int(since_version)
+        with self._writer_lock:
             table = self._get_table(area)
-            return {
-                addr: data
-                for addr, data in table.items()
-                if data["timestamp"] > since
-            }
-        
+            dirty = table.dirty
+            if since_version > self._version:
+                # Cursor de uma Memory anterior ao restart: delta vazio
+                # esconderia que todos os pontos voltaram ao default/UNKNOWN
+                addrs = range(len(table))
+            elif len(dirty) == dirty.maxlen and dirty[0][0] > since_version + 1:
+                versions = table.versions
+                addrs = [a for a in range(len(table)) if versions[a] > since_version]
+            else:
+                seen = set()
+                addrs = []
+                for ver, addr in reversed(dirty):
+                    if ver <= since_version:
+                        break
+                    if addr not in seen:
+                        seen.add(addr)
+                        addrs.append(addr)
+            version = self._version
+            raw = [(addr, table.values[addr], table.quality[addr], table.timestamps[addr])
+                   for addr in addrs]
+        # materializa fora do lock
+        return version, {
+            addr: Point(value, _CODE_TO_NAME[quality_code], ns_to_datetime(ts_ns))
+            for addr, value, quality_code, ts_ns in raw
+        }
+
     def mark_all_ok_as_stale(self):
         """
         Marca como STALE todos os pontos que estão com qualidade OK.
         Não mexe em UNKNOWN, BAD, etc.
         """
-        now = datetime.now().astimezone()
+        now_ns = time.time_ns()
+        ok_code = PointQuality.OK
+        stale_code = PointQuality.STALE
 
-        with self._lock:
-            for area_name in ("HR", "CO", "DI", "IR"):
-                table = self._get_table(area_name)
-                for addr, data in table.items():
-                    if data["quality"] == PointQuality.OK:
-                        data["quality"] = PointQuality.STALE
-                        data["timestamp"] = now
+        with self._writer_lock:
+            for table in self._tables.values():
+                quality = table.quality
+                for addr in range(len(table)):
+                    if quality[addr] == ok_code:
+                        quality[addr] = stale_code
+                        table.timestamps[addr] = now_ns
+                        self._stamp(table, addr)
 
 
 # Teste local
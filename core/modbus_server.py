@@ -10,116 +10,118 @@ Funções:
 - Expõe estatísticas de clientes (IP, leituras, escritas, tempo de conexão)
 """
 
-from threading import Thread, local
-from datetime import datetime
+from array import array
+from threading import Event, Thread, local
 from pymodbus.server.sync import ModbusTcpServer
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import (
-    ModbusServerContext,
-    ModbusSlaveContext,
-    ModbusSequentialDataBlock,
-)
-try:
-    from pymodbus.device import ModbusDeviceIdentification
-except ModuleNotFoundError:
-    from pymodbus import ModbusDeviceIdentification
 
 from core.config_loader import load_config
 from core.memory import Memory
-from core.logger import logger, get_debug_status
+from core.logger import logger
 import socketserver
 import time
+from collections import OrderedDict
 
 _client_context = local()
 
+# Limite de IPs rastreados em self.connections: evita crescimento sem fim
+# ao longo da vida do SoC (IPs antigos saem em ordem LRU)
+_MAX_TRACKED_CONNECTIONS = 1024
+
 
 # ----------------------------------------------------------------------
 # DataBlocks com rastreamento por área (HR/IR = 16-bit; CO/DI = bit/0-1)
 # ----------------------------------------------------------------------
 class TracedSeqBlock(ModbusSequentialDataBlock):
-    """HR/IR: 16-bit words."""
+    """HR/IR: 16-bit words, guardados em array('H') contíguo."""
     def __init__(self, address, values, parent_server=None, area="HR"):
         super().__init__(address, values)
+        # lista -> array('H'): 2 bytes por registrador (igual ao wire format)
+        # e slices de PDU viram memcpy em vez de cópia de lista de PyObjects
+        self.values = array("H", self.values)
         self._server = parent_server
         self._area = area  # "HR" ou "IR"
 
     def getValues(self, address, count=1):
-        values = super().getValues(address, count)
-        if get_debug_status():
-            logger.debug(f"[{self._area}] READ addr={address}, count={count}, values={values}")
+        # slice do array (memcpy) convertido para a lista que o pymodbus espera
+        values = list(super().getValues(address, count))
+        logger.debug("[%s] READ addr=%s, count=%s, values=%s", self._area, address, count, values)
         if self._server:
-            self._server._update_connection_stats("unknown", is_write=False)
+            self._server._update_connection_stats(is_write=False)
         return values
 
     def setValues(self, address, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+
         # IR é somente leitura por definição; ignore se alguém tentar escrever
         if self._area == "IR":
-            if get_debug_status():
-                logger.debug(f"[{self._area}] WRITE IGNORED addr={address}, values={values}")
+            logger.debug("[%s] WRITE IGNORED addr=%s, values=%s", self._area, address, values)
             return
 
-        # --- NOVO BLOCO: sincroniza com Memory central ---
+        # --- Sincroniza com Memory central: um write_range por PDU ---
         if self._server and hasattr(self._server, "_memory"):
-            #base = getattr(self, "address", 0)
-            for i, v in enumerate(values):
-                try:
-                    abs_addr = address + i - 1
-                    self._server._memory.write_point(abs_addr, v, self._area)
-                except Exception as e:
-                    logger.debug(f"Falha ao sincronizar {self._area}[{address+i}] -> {e}")
-        
-        super().setValues(address, values)
+            try:
+                # endereçamento pymodbus é 1-based; a Memory é 0-based
+                self._server._memory.write_range(address - 1, values, self._area)
+            except Exception as e:
+                logger.debug("Falha ao sincronizar %s[%s] -> %s", self._area, address, e)
+
+        # atribuição de slice no array (o setValues base exige lista)
+        start = address - self.address
+        self.values[start:start + len(values)] = array("H", [v & 0xFFFF for v in values])
 
-        if get_debug_status():
-            logger.debug(f"[{self._area}] WRITE addr={address}, values={values}")
+        logger.debug("[%s] WRITE addr=%s, values=%s", self._area, address, values)
 
         if self._server:
-            self._server._update_connection_stats("unknown", is_write=True)
+            self._server._update_connection_stats(is_write=True)
 
 
 class TracedBitBlock(ModbusSequentialDataBlock):
-    """CO/DI: bits 0/1 representados como inteiros 0/1."""
+    """CO/DI: bits 0/1 guardados em bytearray contíguo."""
     def __init__(self, address, values, parent_server=None, area="CO"):
         super().__init__(address, values)
+        # lista -> bytearray: 1 byte por bit e slices de PDU em memcpy
+        self.values = bytearray(1 if v else 0 for v in self.values)
         self._server = parent_server
         self._area = area  # "CO" ou "DI"
 
     def getValues(self, address, count=1):
-        values = super().getValues(address, count)
-        if get_debug_status():
-            logger.debug(f"[{self._area}] READ addr={address}, count={count}, values={values}")
+        # slice do bytearray convertido para a lista de ints que o pymodbus espera
+        values = list(super().getValues(address, count))
+        logger.debug("[%s] READ addr=%s, count=%s, values=%s", self._area, address, count, values)
         if self._server:
-            self._server._update_connection_stats("unknown", is_write=False)
+            self._server._update_connection_stats(is_write=False)
         return values
 
     def setValues(self, address, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+
         # DI é somente leitura; ignore escrita
         if self._area == "DI":
-            if get_debug_status():
-                logger.debug(f"[{self._area}] WRITE IGNORED addr={address}, values={values}")
+            logger.debug("[%s] WRITE IGNORED addr=%s, values=%s", self._area, address, values)
             return
 
-        # normaliza para 0/1
-        norm = [1 if int(v) else 0 for v in values]
-        
-        # --- NOVO BLOCO: sincroniza com Memory central ---
+        # normaliza para 0/1 em um bloco só
+        norm = bytes(1 if v else 0 for v in values)
+
+        # --- Sincroniza com Memory central: um write_range por PDU ---
         if self._server and hasattr(self._server, "_memory"):
-            #base = getattr(self, "address", 0)
-            for i, v in enumerate(norm):
-                try:
-                    abs_addr = address + i - 1
-                    self._server._memory.write_point(abs_addr, v, self._area)
-                except Exception as e:
-                    logger.debug(f"Falha ao sincronizar {self._area}[{address+i}] -> {e}")
+            try:
+                # endereçamento pymodbus é 1-based; a Memory é 0-based
+                self._server._memory.write_range(address - 1, norm, self._area)
+            except Exception as e:
+                logger.debug("Falha ao sincronizar %s[%s] -> %s", self._area, address, e)
 
-        super().setValues(address, norm)
+        start = address - self.address
+        self.values[start:start + len(norm)] = norm
 
-        if get_debug_status():
-            logger.debug(f"[{self._area}] WRITE addr={address}, values={norm}")
+        logger.debug("[%s] WRITE addr=%s, values=%s", self._area, address, list(norm))
 
         if self._server:
-            self._server._update_connection_stats("unknown", is_write=True)
+            self._server._update_connection_stats(is_write=True)
 
 # ---------------------------------------------------------------------------
 # SubClasse de ModbusTcpServer com SO_REUSEADDR ativo.
@@ -140,6 +142,10 @@ class TrackedReusableModbusTcpServer(ModbusTcpServer):
         return super().process_request_thread(request, client_address)
     
     def server_bind(self):
+        # Apenas SO_REUSEADDR (libera o porto do TIME_WAIT). SO_REUSEPORT
+        # ficou de fora de propósito: o driver é single-process por design,
+        # e a opção só serviria para mascarar o EADDRINUSE de uma segunda
+        # instância acidental, com o kernel dividindo clientes entre elas.
         self.socket.setsockopt(socketserver.socket.SOL_SOCKET, socketserver.socket.SO_REUSEADDR, 1)
         super().server_bind()
 
@@ -153,11 +159,21 @@ class ModbusServer(Thread):
         super().__init__(daemon=True)
 
         self._startup_error = None   # armazena exceção de inicialização
+        # Sinalizado pela thread do servidor quando a inicialização resolve
+        # (sucesso ou _startup_error); o manager espera nele em vez de pollar
+        self._ready_event = Event()
+        # Sinalizado quando o loop TCP terminou e o socket foi liberado;
+        # o restart espera nele em vez de dormir um tempo fixo
+        self._stopped_event = Event()
 
         self._memory = memory
         self._server_instance = None
         self._running = False
-        self.connections = {}
+        self.connections = OrderedDict()  # IP -> stats, em ordem LRU (cap _MAX_TRACKED_CONNECTIONS)
+        # Versão dos contadores de conexão: bump a cada registro/operação de
+        # cliente. Entra na chave do cache de /status, que de outra forma não
+        # enxergaria mudanças em reads/writes dentro do mesmo segundo.
+        self.stats_version = 0
 
         # Lê as configurações em config/settings.ini
         self.config = load_config()
@@ -166,6 +182,10 @@ class ModbusServer(Thread):
         self.timeout = self.config.getint("MODBUS", "timeout", fallback=5)
         self.unit_id = self.config.getint("MODBUS", "unit_id", fallback=1)
 
+        # Identificação do dispositivo como dict plano: evita cinco
+        # config.get (com interpolação do configparser) dentro de run()
+        self._device_info = dict(self.config.items("DEVICE")) if self.config.has_section("DEVICE") else {}
+
         # Tempo máximo de inatividade (em segundos) para marcar pontos como STALE
         self.point_quality_timeout = self.config.getint("MEMORY", "point_quality_timeout", fallback=0)
         # Flag interna para evitar log repetitivo toda hora
@@ -177,10 +197,11 @@ class ModbusServer(Thread):
         # ------------------------------------------------------------
 
         # Blocos com tracer por área, carregando diretamente da Memory correta
-        hr_values = [v["value"] for v in self._memory.all_points("HR").values()]
-        ir_values = [v["value"] for v in self._memory.all_points("IR").values()]
-        co_values = [v["value"] for v in self._memory.all_points("CO").values()]
-        di_values = [v["value"] for v in self._memory.all_points("DI").values()]
+        # (snapshot_values devolve list[int] sem materializar Points)
+        hr_values = self._memory.snapshot_values("HR")
+        ir_values = self._memory.snapshot_values("IR")
+        co_values = self._memory.snapshot_values("CO")
+        di_values = self._memory.snapshot_values("DI")
 
         # Evita blocos vazios
         hr_values = hr_values or [0]
@@ -204,11 +225,12 @@ class ModbusServer(Thread):
         """Executa o servidor TCP Modbus (modo síncrono, pymodbus 2.5.3)."""
         try:
             identity = ModbusDeviceIdentification()
-            identity.VendorName = self.config.get("DEVICE", "vendor_name", fallback="Generic Vendor")
-            identity.ProductCode = self.config.get("DEVICE", "product_code", fallback="GEN")
-            identity.VendorUrl = self.config.get("DEVICE", "vendor_url", fallback="http://localhost")
-            identity.ProductName = self.config.get("DEVICE", "product_name", fallback="Modbus Driver")
-            identity.MajorMinorRevision = self.config.get("DEVICE", "revision", fallback="1.0.0")
+            dev = self._device_info
+            identity.VendorName = dev.get("vendor_name", "Generic Vendor")
+            identity.ProductCode = dev.get("product_code", "GEN")
+            identity.VendorUrl = dev.get("vendor_url", "http://localhost")
+            identity.ProductName = dev.get("product_name", "Modbus Driver")
+            identity.MajorMinorRevision = dev.get("revision", "1.0.0")
 
             self._server_instance = TrackedReusableModbusTcpServer(
                 context=self.context,
@@ -219,6 +241,7 @@ class ModbusServer(Thread):
             
             # Só muda pra True após conseguir instanciar o ModbusTcpServer
             self._running = True
+            self._ready_event.set()
             logger.info(f"Modbus Server iniciado em {self.host}:{self.port}")
 
             # Inicia monitor de inatividade para marcar pontos STALE
@@ -230,6 +253,10 @@ class ModbusServer(Thread):
             logger.error(f"Erro no servidor Modbus: {e}")
         finally:
             self._running = False
+            # Garante que quem espera o handshake acorde mesmo em falha
+            self._ready_event.set()
+            # Loop TCP encerrado e socket fechado: libera quem espera o stop
+            self._stopped_event.set()
             logger.info("Servidor Modbus finalizado.")
 
     # ------------------------------------------------------------------
@@ -250,9 +277,14 @@ class ModbusServer(Thread):
         return self._running
 
     # ------------------------------------------------------------------
-    def _register_client_connection(self, client_ip: str):
-        """Registra novo cliente conectado."""
-        now = datetime.now().astimezone()
+    def _register_client_connection(self, client_ip: str, now: float = None):
+        """
+        Registra novo cliente conectado (timestamps em epoch float).
+        A cada conexão o IP vai para o fim da ordem LRU; passado o limite,
+        o IP mais frio é descartado.
+        """
+        if now is None:
+            now = time.time()
         if client_ip not in self.connections:
             self.connections[client_ip] = {
                 "ip": client_ip,
@@ -261,20 +293,33 @@ class ModbusServer(Thread):
                 "reads": 0,
                 "writes": 0,
             }
+            if len(self.connections) > _MAX_TRACKED_CONNECTIONS:
+                self.connections.popitem(last=False)
+        else:
+            self.connections.move_to_end(client_ip)
+        self.stats_version += 1
 
     # ------------------------------------------------------------------
     def _update_connection_stats(self, client_ip=None, is_write=False):
-        now = datetime.now().astimezone()
+        # Roda a cada operação Modbus: time.time() em vez de
+        # datetime.now().astimezone(), que refaz o lookup de fuso a cada chamada.
+        now = time.time()
         if not client_ip or client_ip == "unknown":
             client_ip = getattr(_client_context, "ip", "unknown")  # <-- busca o IP da thread atual
-        if client_ip not in self.connections:
-            self._register_client_connection(client_ip)
-        conn = self.connections[client_ip]
-        conn["last_seen"] = now
-        if is_write:
-            conn["writes"] += 1
+        # um único lookup de hash no caminho quente
+        conn = self.connections.get(client_ip)
+        if conn is None:
+            # reaproveita o timestamp já lido nesta operação
+            self._register_client_connection(client_ip, now)
+            conn = self.connections[client_ip]
         else:
-            conn["reads"] += 1
+            # refresca a recência LRU a cada operação (O(1) no OrderedDict):
+            # senão um IP ativo numa conexão longa envelhece para a ponta
+            # fria e é descartado antes de IPs ociosos que só reconectaram
+            self.connections.move_to_end(client_ip)
+        conn["last_seen"] = now
+        conn["writes" if is_write else "reads"] += 1
+        self.stats_version += 1
     
     def _get_last_activity(self):
         """
@@ -298,11 +343,10 @@ class ModbusServer(Thread):
         def monitor_loop():
             while self._running:
                 try:
-                    now = datetime.now().astimezone()
                     last_activity = self._get_last_activity()
 
                     if last_activity is not None:
-                        elapsed = (now - last_activity).total_seconds()
+                        elapsed = time.time() - last_activity
                         timeout_secs = self.point_quality_timeout
 
                         if elapsed > timeout_secs:
@@ -15,7 +15,7 @@ import uvicorn
 from core.logger import logger
 from core.config_loader import load_config
 from manager.modbus_driver_manager import ModbusDriverManager
-from api.server_api import app
+from api.server_api import app, set_manager
 
 
 def main():
@@ -26,9 +26,9 @@ def main():
     api_host = cfg.get("API", "host", fallback="0.0.0.0")
     api_port = cfg.getint("API", "port", fallback=8000)
 
-    # Cria o gerenciador
+    # Cria o gerenciador e registra na API
     manager = ModbusDriverManager()
-    app.state.manager = manager
+    set_manager(manager)
 
     # Captura sinais do systemd (stop/restart)
     def handle_shutdown(sig, frame):
@@ -39,7 +39,12 @@ def main():
     signal.signal(signal.SIGTERM, handle_shutdown)
     signal.signal(signal.SIGINT, handle_shutdown)
 
-    uvicorn.run(app, host=api_host, port=api_port, log_level="info")
+    # loop/http "auto" ativam uvloop e httptools quando instalados.
+    # Mantém 1 worker: manager e Memory moram neste processo; múltiplos
+    # workers significariam N servidores Modbus disputando a mesma porta
+    # e memórias divergentes entre si.
+    uvicorn.run(app, host=api_host, port=api_port, log_level="info",
+                loop="auto", http="auto")
 
 if __name__ == "__main__":
     main()
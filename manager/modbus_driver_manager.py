@@ -5,13 +5,15 @@ Gerencia o ciclo de vida do servidor Modbus.
 Controla start, stop, restart, status e watchdog automático.
 """
 
+import os
+import signal
 import threading
 import time
 from datetime import datetime
 from core.memory import Memory
 from core.logger import logger, set_debug, get_debug_status
 from core.modbus_server import ModbusServer
-from core.config_loader import load_config
+from core.config_loader import load_config, reload_config, CONFIG_PATH
 
 
 class ModbusDriverManager:
@@ -23,81 +25,144 @@ class ModbusDriverManager:
     def __init__(self):
         self.server = None
         self.start_time = None
-        self._lock = threading.Lock()
-        self.stats = {"starts": 0, "stops": 0, "errors": 0}
+        # Base monotônica do uptime: imune a saltos do relógio de parede (NTP)
+        self._start_monotonic = None
+        # Serializa apenas transições de estado (start/stop); leitores de
+        # status e o watchdog trabalham sobre snapshots, sem lock
+        self._transition_lock = threading.Lock()
+        # Contadores como atributos inteiros simples; o dict só é montado
+        # sob demanda em get_status (sem hashing de chave no caminho quente)
+        self._starts = 0
+        self._stops = 0
+        self._errors = 0
         self._watchdog_active = False
         self._watchdog_thread = None
+        # Incrementado a cada transição de estado (start/stop/debug); permite
+        # à API cachear o /status serializado enquanto nada mudou.
+        self._status_version = 0
+        # Cache do settings.ini parseado, invalidado por st_mtime (o restart
+        # do watchdog não deve reler/reparsear o arquivo a cada disparo)
+        self.cfg = None
+        self._cfg_mtime = None
+        # Recarga a quente via SIGHUP (padrão systemd reload): aplica novos
+        # parâmetros de watchdog sem reiniciar o driver. SIGHUP não existe
+        # no Windows, e signal.signal só funciona na thread principal.
+        if hasattr(signal, "SIGHUP"):
+            try:
+                signal.signal(signal.SIGHUP, self._handle_sighup)
+            except ValueError:
+                logger.debug("SIGHUP não registrado (fora da thread principal).")
+
+    def _handle_sighup(self, signum, frame):
+        logger.info("SIGHUP recebido: recarregando settings.ini.")
+        self._reload_config()
+
+    def _reload_config(self):
+        """
+        Relê o settings.ini (guardado por st_mtime no _get_config) e aplica
+        os parâmetros de watchdog a quente; o loop usa o novo intervalo no
+        próximo tick, sem restart do servidor. As atribuições são atômicas,
+        então não há lock a disputar com o watchdog.
+        """
+        self._get_config()
+        self._watchdog_interval = self._wd_interval
+        self._watchdog_enabled = self._wd_enabled
+        self._watchdog_max_retries = self._wd_max_retries
+
+    def _get_config(self):
+        """
+        Devolve o ConfigParser do settings.ini, relendo o arquivo do disco
+        apenas quando o st_mtime mudou desde a última leitura (o Node-RED
+        edita o arquivo antes de pedir start/restart). Os parâmetros
+        derivados (memória e watchdog) são convertidos uma vez por versão
+        do arquivo, e não a cada start.
+        """
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime
+        except OSError:
+            mtime = None
+        if self.cfg is None or mtime != self._cfg_mtime:
+            reload_config()
+            self.cfg = load_config()
+            self._cfg_mtime = mtime
+
+            self._mem_params = {
+                "hr_count": self.cfg.getint("MEMORY", "hr_count", fallback=100),
+                "co_count": self.cfg.getint("MEMORY", "coil_count", fallback=0),
+                "di_count": self.cfg.getint("MEMORY", "di_count", fallback=0),
+                "ir_count": self.cfg.getint("MEMORY", "ir_count", fallback=0),
+                "default_value": self.cfg.getint("MEMORY", "default_value", fallback=0),
+            }
+            self._wd_interval = self.cfg.getint("WATCHDOG", "interval_seconds", fallback=10)
+            self._wd_enabled = self.cfg.getboolean("WATCHDOG", "enabled", fallback=True)
+            self._wd_max_retries = self.cfg.getint("WATCHDOG", "max_retries", fallback=5)
+        return self.cfg
 
     # ----------------------------------------------------------------------
     # Controle principal
     # ----------------------------------------------------------------------
     def start_driver(self):
         """Inicia o servidor Modbus."""
-        with self._lock:
+        # Try-lock não bloqueante: se /restart e o watchdog dispararem juntos,
+        # o segundo chamador não fica enfileirado atrás de um start que pode
+        # levar segundos — ele só veria o estado final e desistiria.
+        if not self._transition_lock.acquire(blocking=False):
+            logger.warning("Start ignorado: outra transição de estado em andamento.")
+            return False
+        try:
             if self.server and self.server.is_running():
                 logger.warning("Tentativa de iniciar driver já em execução.")
                 return False
             
-            #Lê as configurações do arquivo settings.ini
-            self.cfg = load_config()
+            # Relê as configurações só se o settings.ini mudou no disco
+            # (o Node-RED pode ter editado o arquivo antes do start/restart)
+            self._get_config()
 
-            # --- Parâmetros de memória ---
-            hr_count = self.cfg.getint("MEMORY", "hr_count", fallback=100)
-            co_count = self.cfg.getint("MEMORY", "coil_count", fallback=0)
-            di_count = self.cfg.getint("MEMORY", "di_count", fallback=0)
-            ir_count = self.cfg.getint("MEMORY", "ir_count", fallback=0)
-            def_val = self.cfg.getint("MEMORY", "default_value", fallback=0)
-
-            self.memory = Memory(
-                hr_count=hr_count,
-                co_count=co_count,
-                di_count=di_count,
-                ir_count=ir_count,
-                default_value=def_val,
-            )
+            # --- Parâmetros de memória (derivados no _get_config) ---
+            self.memory = Memory(**self._mem_params)
 
             # Configuração do watchdog
-            self._watchdog_interval = self.cfg.getint("WATCHDOG", "interval_seconds", fallback=10)
-            self._watchdog_enabled = self.cfg.getboolean("WATCHDOG", "enabled", fallback=True)
+            self._watchdog_interval = self._wd_interval
+            self._watchdog_enabled = self._wd_enabled
             self._manual_stop = False
-            self._watchdog_max_retries = self.cfg.getint("WATCHDOG", "max_retries", fallback=5)
+            self._watchdog_max_retries = self._wd_max_retries
 
             try:
                 logger.info("Iniciando Servidor Modbus.")
                 self.server = ModbusServer(memory=self.memory)
                 self.server.start()
 
-                # --- Aguarda inicialização da thread ---
-                import time
-                timeout = time.time() + 3  # até 3 segundos
-                while time.time() < timeout:
-                    if self.server._startup_error:
-                        break
-                    if self.server.is_running():
-                        break
-                    time.sleep(0.1)
+                # --- Aguarda o handshake de inicialização da thread ---
+                # A thread do servidor sinaliza o evento tanto no sucesso
+                # quanto ao registrar _startup_error: uma espera bloqueante
+                # única, sem o poll de 100 ms.
+                self.server._ready_event.wait(timeout=3)
 
                 # --- Avalia resultado ---
                 if self.server._startup_error:
                     err = self.server._startup_error
-                    self.stats["errors"] += 1
+                    self._errors += 1
+                    self._status_version += 1
                     self.server.shutdown()
                     self.server = None
                     return False
 
                 if not self.server.is_running():
-                    self.stats["errors"] += 1
+                    self._errors += 1
+                    self._status_version += 1
                     logger.error("Servidor Modbus não iniciou dentro do tempo limite. Encerrando thread por segurança.")
                     try:
                         self.server.shutdown()
                     except Exception as e:
-                        logger.debug(f"Falha ao encerrar servidor após timeout: {e}")
+                        logger.debug("Falha ao encerrar servidor após timeout: %s", e)
                     self.server = None
                     return False
 
                 # --- Sucesso ---
                 self.start_time = datetime.now().astimezone()
-                self.stats["starts"] += 1
+                self._start_monotonic = time.monotonic()
+                self._starts += 1
+                self._status_version += 1
                 logger.info("Driver Modbus iniciado com sucesso.")
                 if self._watchdog_enabled:
                     self._start_watchdog()
@@ -105,13 +170,19 @@ class ModbusDriverManager:
                 return True
 
             except Exception as e:
-                self.stats["errors"] += 1
-                logger.error(f"Erro ao iniciar driver: {e}")
+                self._errors += 1
+                self._status_version += 1
+                logger.error("Erro ao iniciar driver: %s", e)
                 return False
+        finally:
+            self._transition_lock.release()
 
     def stop_driver(self):
         """Para o servidor Modbus."""
-        with self._lock:
+        if not self._transition_lock.acquire(blocking=False):
+            logger.warning("Stop ignorado: outra transição de estado em andamento.")
+            return False
+        try:
             if not self.server or not self.server.is_running():
                 logger.warning("Tentativa de parar driver que não está em execução.")
                 return False
@@ -121,20 +192,29 @@ class ModbusDriverManager:
                 logger.info("Solicitando parada do servidor Modbus.")
                 self._manual_stop = True
                 self.server.shutdown()  # encerra socket e loop TCP
-                self.stats["stops"] += 1
+                self._stops += 1
+                self._status_version += 1
                 logger.info("Driver Modbus parado manualmente (API ou terminal).")
                 return True
 
             except Exception as e:
-                self.stats["errors"] += 1
-                logger.error(f"Erro ao parar driver: {e}")
+                self._errors += 1
+                self._status_version += 1
+                logger.error("Erro ao parar driver: %s", e)
                 return False
+        finally:
+            self._transition_lock.release()
 
     def restart_driver(self):
         """Reinicia o servidor."""
         logger.info("Reiniciando driver Modbus.")
+        server = self.server
         self.stop_driver()
-        time.sleep(2)
+        # Espera o loop TCP realmente encerrar e liberar o socket (tipicamente
+        # dezenas de ms) em vez dos 2 s fixos de antes; o timeout preserva o
+        # teto antigo caso a thread trave.
+        if server is not None:
+            server._stopped_event.wait(timeout=2)
         self._manual_stop = False
         return self.start_driver()
 
@@ -152,66 +232,97 @@ class ModbusDriverManager:
         logger.debug("Watchdog iniciado.")
 
     def _watchdog_loop(self):
+        # Agenda por deadline no relógio monotônico: o intervalo não deriva
+        # com o custo de cada ciclo nem com ajustes de NTP no relógio de parede
+        next_tick = time.monotonic() + self._watchdog_interval
         while self._watchdog_active:
             try:
-                time.sleep(self._watchdog_interval)
+                time.sleep(max(0.0, next_tick - time.monotonic()))
+                next_tick += self._watchdog_interval
                 restart_needed = False
                 #logger.debug(f"Watchdog: \ndriver_running({self.server and self.server.is_running()})\nself._watchdog_retry_count({self._watchdog_retry_count})\nself._manual_stop({self._manual_stop})\nrestart_needed({restart_needed})\n\n")
 
-                with self._lock:
-                    driver_running = self.server and self.server.is_running()
-
-                    if driver_running:
-                        if self._watchdog_retry_count > 0:
-                            logger.info("Watchdog: servidor voltou ao normal, zerando contador.")
-                        self._watchdog_retry_count = 0
-                        continue
-
-                    if self._manual_stop:
-                        logger.debug("Watchdog: parada manual detectada. Ignorando.")
-                        continue
-
-                    if self._watchdog_max_retries > 0 and \
-                    self._watchdog_retry_count >= self._watchdog_max_retries:
-                        logger.error(
-                            f"Watchdog atingiu o limite de {self._watchdog_max_retries} tentativas. "
-                            "Monitoramento encerrado."
-                        )
-                        self._watchdog_active = False
-                        break
-
-                    self._watchdog_retry_count += 1
-                    logger.warning(
-                        f"Watchdog detectou falha. Tentativa #{self._watchdog_retry_count} "
-                        f"de reiniciar o driver."
+                # Snapshot sem lock: a leitura de self.server é atômica e
+                # _watchdog_retry_count só é mutado por esta thread. Assim o
+                # ciclo de checagem não disputa o lock de transição com um
+                # start_driver em andamento (que pode levar segundos).
+                server = self.server
+                driver_running = server and server.is_running()
+
+                if driver_running:
+                    if self._watchdog_retry_count > 0:
+                        logger.info("Watchdog: servidor voltou ao normal, zerando contador.")
+                    self._watchdog_retry_count = 0
+                    continue
+
+                if self._manual_stop:
+                    logger.debug("Watchdog: parada manual detectada. Ignorando.")
+                    continue
+
+                if self._watchdog_max_retries > 0 and \
+                self._watchdog_retry_count >= self._watchdog_max_retries:
+                    logger.error(
+                        "Watchdog atingiu o limite de %d tentativas. "
+                        "Monitoramento encerrado.",
+                        self._watchdog_max_retries,
                     )
-                    restart_needed = True
+                    self._watchdog_active = False
+                    break
+
+                self._watchdog_retry_count += 1
+                logger.warning(
+                    "Watchdog detectou falha. Tentativa #%d de reiniciar o driver.",
+                    self._watchdog_retry_count,
+                )
+                restart_needed = True
 
             except Exception as e:
-                logger.error(f"ERRO CRÍTICO DENTRO DO WATCHDOG: {e}")
+                logger.error("ERRO CRÍTICO DENTRO DO WATCHDOG: %s", e)
 
             if restart_needed:
                 try:
                     self.restart_driver()
                 except Exception as e:
-                    logger.error(f"Watchdog falhou ao reiniciar driver: {e}")
+                    logger.error("Watchdog falhou ao reiniciar driver: %s", e)
 
 
     # ----------------------------------------------------------------------
     # Status e debug
     # ----------------------------------------------------------------------
+    @property
+    def status_version(self) -> int:
+        """Versão do estado do driver (muda a cada start/stop/debug)."""
+        return self._status_version
+
     def get_status(self):
         """Retorna o status atual do driver."""
         uptime = None
-        if self.start_time:
-            uptime = str(datetime.now().astimezone() - self.start_time).split(".")[0]
-
-        connections = self.server.connections if self.server else {}
+        if self._start_monotonic is not None:
+            # subtração de monotônicos + divmod: sem datetime/timedelta no caminho
+            secs = int(time.monotonic() - self._start_monotonic)
+            hours, rem = divmod(secs, 3600)
+            minutes, seconds = divmod(rem, 60)
+            uptime = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+        # first_seen/last_seen vivem como epoch float no caminho quente do
+        # servidor Modbus; a conversão para datetime acontece só aqui, na borda
+        # da API (e o /status cacheia o resultado serializado por até 1 s).
+        # Snapshot único de self.server: um stop_driver concorrente pode
+        # trocar o atributo para None entre dois acessos consecutivos.
+        srv = self.server
+        connections = {}
+        if srv is not None:
+            for ip, conn in srv.connections.items():
+                connections[ip] = {
+                    **conn,
+                    "first_seen": datetime.fromtimestamp(conn["first_seen"]).astimezone(),
+                    "last_seen": datetime.fromtimestamp(conn["last_seen"]).astimezone(),
+                }
         status = {
-            "running": self.server.is_running() if self.server else False,
+            "running": srv.is_running() if srv is not None else False,
             "uptime": uptime,
             "debug": get_debug_status(),
-            "stats": self.stats,
+            "stats": {"starts": self._starts, "stops": self._stops, "errors": self._errors},
             "connections": connections,
         }
         return status
@@ -219,7 +330,8 @@ class ModbusDriverManager:
     def set_debug_mode(self, enable: bool):
         """Ativa ou desativa modo debug."""
         set_debug(enable)
-        logger.info(f"Modo debug {'ativado' if enable else 'desativado'}.")
+        self._status_version += 1
+        logger.info("Modo debug %s.", "ativado" if enable else "desativado")
         return get_debug_status()
 
 
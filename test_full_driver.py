@@ -14,12 +14,23 @@ Fluxo:
 
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from pymodbus.client.sync import ModbusTcpClient
 
 API_URL = "http://127.0.0.1:8000"
 MODBUS_HOST = "127.0.0.1"
 MODBUS_PORT = 5020
 
+# Alvo é sempre loopback IPv4: desliga a tentativa dual-stack (AAAA) do
+# urllib3 para não pagar resolução IPv6 a cada conexão
+requests.packages.urllib3.util.connection.HAS_IPV6 = False
+
+# Sessão HTTP única para todo o teste: keep-alive + pool de conexões,
+# em vez de um handshake TCP novo a cada requests.get/post. O pool fica
+# fixo em 1 conexão — só existe um host (a API local) e um chamador.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
 
 # ----------------------------------------------------------------------
 # Utilitários
@@ -28,9 +39,9 @@ def api_request(method, endpoint):
     url = f"{API_URL}{endpoint}"
     try:
         if method == "GET":
-            r = requests.get(url, timeout=5)
+            r = SESSION.get(url, timeout=5)
         else:
-            r = requests.post(url, timeout=5)
+            r = SESSION.post(url, timeout=5)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -38,6 +49,26 @@ def api_request(method, endpoint):
         return None
 
 
+def wait_until(condition, timeout=5, interval=0.05):
+    """
+    Faz poll curto até condition() ser verdadeiro (ou estourar o timeout).
+    Substitui os time.sleep fixos: o teste segue assim que o estado
+    observável chega, em vez de esperar o pior caso.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        value = condition()
+        if value:
+            return value
+        time.sleep(interval)
+    return None
+
+
+def driver_running():
+    status = api_request("GET", "/status")
+    return bool(status and status.get("running"))
+
+
 def print_section(title):
     print("\n" + "=" * 80)
     print(f"{title}")
@@ -55,34 +86,31 @@ def test_api_sequence():
 
     print("\n→ /start")
     print(api_request("POST", "/start"))
-    time.sleep(3)
+    wait_until(driver_running)
 
     print("\n→ /debug/on")
     print(api_request("POST", "/debug/on"))
 
     print("\n→ /restart")
     print(api_request("POST", "/restart"))
-    time.sleep(4)
+    wait_until(driver_running, timeout=10)
 
     print("\n→ /status")
     print(api_request("GET", "/status"))
 
 
 def discover_memory_sizes():
-    """Obtém o tamanho de cada área consultando a API."""
+    """Obtém o tamanho das quatro áreas em uma única chamada à API."""
     print_section("🔹 Descobrindo tamanhos de memória via API")
-    sizes = {}
-    for area in ["HR", "CO", "DI", "IR"]:
-        try:
-            r = requests.get(f"{API_URL}/points?area={area}", timeout=5)
-            if r.status_code == 200:
-                data = r.json()
-                sizes[area] = len(data.get("points", {}))
-            else:
-                sizes[area] = 0
-        except Exception as e:
-            print(f"[ERRO] Falha ao ler área {area}: {e}")
-            sizes[area] = 0
+    sizes = {area: 0 for area in ["HR", "CO", "DI", "IR"]}
+    try:
+        r = SESSION.get(f"{API_URL}/points?area=ALL", timeout=5)
+        if r.status_code == 200:
+            data = r.json()
+            for area in sizes:
+                sizes[area] = len(data.get(area, {}).get("points", {}))
+    except Exception as e:
+        print(f"[ERRO] Falha ao ler áreas: {e}")
     print("Tamanhos detectados:", sizes)
     return sizes
 
@@ -90,15 +118,10 @@ def discover_memory_sizes():
 # ----------------------------------------------------------------------
 # Testes Modbus + API cruzados
 # ----------------------------------------------------------------------
-def test_modbus_and_api_consistency(sizes):
+def test_modbus_and_api_consistency(sizes, client):
     """Compara leituras/escritas Modbus vs API."""
     print_section("🔹 Testando coerência Modbus ↔ API")
 
-    client = ModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT)
-    if not client.connect():
-        print("[ERRO] Não foi possível conectar ao Modbus Server.")
-        return False
-
     try:
         hr_n = sizes.get("HR", 1)
         co_n = sizes.get("CO", 1)
@@ -106,25 +129,35 @@ def test_modbus_and_api_consistency(sizes):
         ir_n = sizes.get("IR", 1)
 
         # --- HR ---
-        test_value = 999
-        print(f"Escrevendo HR[0]={test_value} via Modbus…")
-        client.write_register(0, test_value, unit=1)
-        time.sleep(2.5)
-
-        api_val = requests.get(f"{API_URL}/points?address=0&area=HR").json()["value"]
-        rr = client.read_holding_registers(0, 1, unit=1)
-        modbus_val = rr.registers[0] if not rr.isError() else None
-        print(f"→ API: {api_val}, Modbus: {modbus_val}")
-        assert api_val == modbus_val, "Valor HR incoerente entre API e Modbus"
+        # Escrita múltipla (FC16) + leitura do banco inteiro (FC03): um PDU
+        # em cada direção, em vez de um round-trip por registrador
+        test_values = [999, 1000, 1001, 1002, 1003][:hr_n]
+        print(f"Escrevendo HR[0..{len(test_values) - 1}]={test_values} via Modbus…")
+        client.write_registers(0, test_values, unit=1)
+        wait_until(lambda: SESSION.get(
+            f"{API_URL}/points?address=0&area=HR", timeout=5).json().get("value") == test_values[0])
+
+        points = SESSION.get(f"{API_URL}/points?area=HR", timeout=5).json()["points"]
+        api_vals = [points[str(a)]["value"] for a in range(len(test_values))]
+        # FC03 aceita no máximo 125 registradores por PDU; hr_count é
+        # configurável e pode passar disso
+        rr = client.read_holding_registers(0, min(hr_n, 125), unit=1)
+        modbus_vals = rr.registers[:len(test_values)] if not rr.isError() else None
+        print(f"→ API: {api_vals}, Modbus: {modbus_vals}")
+        # if/raise em vez de assert: continua valendo sob python -O
+        if not (api_vals == modbus_vals == test_values):
+            raise AssertionError("Valores HR incoerentes entre API e Modbus")
 
         # --- CO ---
         print("Escrevendo CO[0]=1 via API…")
-        requests.post(f"{API_URL}/points", json={"area": "CO", "address": 0, "value": 1})
-        time.sleep(0.5)
+        SESSION.post(f"{API_URL}/points", json={"area": "CO", "address": 0, "value": 1})
+        wait_until(lambda: SESSION.get(
+            f"{API_URL}/points?address=0&area=CO", timeout=5).json().get("value") == 1)
         rr = client.read_coils(0, co_n, unit=1)
         bits = rr.bits[:co_n]
         print(f"→ CO lido via Modbus: {bits}")
-        assert bits[0] is True, "CO[0] não refletiu escrita via API"
+        if bits[0] is not True:
+            raise AssertionError("CO[0] não refletiu escrita via API")
 
         # --- DI ---
         rr = client.read_discrete_inputs(0, di_n, unit=1)
@@ -142,8 +175,6 @@ def test_modbus_and_api_consistency(sizes):
     except Exception as e:
         print(f"[ERRO CONSISTÊNCIA] {e}")
         return False
-    finally:
-        client.close()
 
 
 # ----------------------------------------------------------------------
@@ -151,12 +182,9 @@ def test_modbus_and_api_consistency(sizes):
 # ----------------------------------------------------------------------
 def verify_connection_status():
     print_section("🔹 Verificando status do driver após leituras")
-    status = api_request("GET", "/status")
-    if not status:
-        print("❌ Falha ao consultar /status.")
-        return False
-
-    conns = status.get("connections", {})
+    # Poll até os contadores de conexão aparecerem em /status, em vez de
+    # falhar numa leitura única logo após o tráfego Modbus
+    conns = wait_until(lambda: (api_request("GET", "/status") or {}).get("connections"))
     if not conns:
         print("❌ Nenhuma conexão registrada.")
         return False
@@ -174,7 +202,7 @@ def finalize_driver():
     print(api_request("POST", "/debug/off"))
     print("\n→ /stop")
     print(api_request("POST", "/stop"))
-    time.sleep(2)
+    wait_until(lambda: not driver_running())
     print("\n→ /status final")
     print(api_request("GET", "/status"))
 
@@ -182,11 +210,11 @@ def finalize_driver():
 def test_api_with_driver_stopped():
     print_section("🔹 Testando acesso à API com driver parado")
 
-    r = requests.get(f"{API_URL}/points?address=0&area=HR")
+    r = SESSION.get(f"{API_URL}/points?address=0&area=HR")
     print("→ GET /points HR[0] com driver parado:", r.status_code, r.text)
 
     payload = {"address": 0, "value": 123, "area": "HR"}
-    r = requests.post(f"{API_URL}/points", json=payload)
+    r = SESSION.post(f"{API_URL}/points", json=payload)
     print("→ POST /points HR[0] com driver parado:", r.status_code, r.text)
 
 
@@ -197,10 +225,22 @@ if __name__ == "__main__":
     print("=== TESTE COMPLETO DO DRIVER MODBUS ===")
 
     test_api_sequence()
-    time.sleep(5)
+    wait_until(driver_running)
 
     sizes = discover_memory_sizes()
-    ok_consistency = test_modbus_and_api_consistency(sizes)
+
+    # Um único cliente Modbus para a suíte inteira: uma conexão TCP por
+    # controlador, sem ciclos connect/close a cada função de teste
+    client = ModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT)
+    if not client.connect():
+        print("[ERRO] Não foi possível conectar ao Modbus Server.")
+        ok_consistency = False
+    else:
+        try:
+            ok_consistency = test_modbus_and_api_consistency(sizes, client)
+        finally:
+            client.close()
+
     ok_status = verify_connection_status()
 
     finalize_driver()